@@ -5,10 +5,15 @@ import plotly.express as px
 # import plotly.io as pio
 from collections import defaultdict
 import base64
-from plotly.subplots import make_subplots
+import logging
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 
+logger = logging.getLogger(__name__)
+
 ##############################
 ## LIST OF INPUT PARAMETERS ##
 ##############################
@@ -59,6 +64,17 @@ additional_params = {'title': 'Plot title (str, optional)',
                                      '\nList of str of len<=nr_subplots, if subplots=True)',
                      'quartilemethod': 'Method to compute quartiles (str, \'exclusive\', \'inclusive\', \'linear\', only for kind=\'box\')',
                      'barmode': 'Sets how bars at the same location are displayed (str, \'stack\', \'relative\', \'group\', default=\'overlay\')',
+                     'max_points': 'Maximum number of points passed to the 3D scene (int, optional, only for kind=\'scatter3d\'). '
+                                   '\nIf data has more rows, it is decimated according to \'decimation\'',
+                     'decimation': 'Decimation method used when \'max_points\' is exceeded (str, \'voxel\': one point per cell of a regular 3D grid, '
+                                   '\n\'random\': random sampling stratified over a regular 3D grid, default=\'voxel\', only for kind=\'scatter3d\')',
+                     'subplot_cols': 'Number of columns of the subplots grid (int, default=1, only if subplots=True)',
+                     'lean_memory': 'Bool, if True, plotted float64 columns are cast to float32 where the rounding error is negligible '
+                                    '\nwith respect to the column range (default=False)',
+                     'report_memory': 'Bool, if True, the peak memory of the call is traced with tracemalloc (slow) and stored in fig._tc_report (default=False). '
+                                      '\nIf tracemalloc is already tracing, its peak is reset by the call; the peak before the call is stored as well',
+                     'max_bytes': 'Size budget of the serialized figure (int, bytes, optional, plotly.js library excluded). If exceeded, hover data are dropped, '
+                                  '\ndata are cast to float32 and traces are downsampled until the figure fits. Reductions are logged as warnings and stored in fig._tc_report',
                      }
 
 
@@ -314,7 +330,7 @@ def inner_plot(plot_fun, data, x, y, z, main_logo_source, proj_logo_source, fun_
 
     if z is not None:  # 3D
         if plot_fun == px.imshow:
-            inner_data = data.set_index([x, y])[z].unstack()
+            inner_data = data.pivot(index=x, columns=y, values=z)
             fig = plot_fun(inner_data, **fun_params)
         elif (plot_fun == px.scatter_3d) or (plot_fun == px.line_3d):
             fig = plot_fun(data, x=x, y=y, z=z, **fun_params).update_traces(**traces_params)
@@ -367,53 +383,101 @@ def inner_plot(plot_fun, data, x, y, z, main_logo_source, proj_logo_source, fun_
 ############################
 def calc_subplots(data):
     if data.columns.nlevels > 1:
-        data = data.sort_index(axis=1, level=list(range(data.columns.nlevels)))
-        # level_list = []
-        # for ll in range(df.columns.nlevels-1):
-        #     level_list.append(df.columns.get_level_values(ll).unique())
-        level_list = data.columns.levels[:-1]
-        idx_subplots_temp = pd.MultiIndex.from_product(level_list)  #
-        idx_subplots = list(set(idx_subplots_temp) & set([T[:-1] for T in data.columns]))
-        idx_subplots.sort()
+        idx_subplots = sorted(set(T[:-1] for T in data.columns))
     else:
         idx_subplots = data.columns
     n_sp = len(idx_subplots)
     return idx_subplots, n_sp
 
 
+def group_columns(data):
+    # Columns of each subplot, collected in one pass without slicing data
+    groups = defaultdict(list)
+    multi_level = data.columns.nlevels > 1
+    for T in data.columns:
+        groups[T[:-1] if multi_level else T].append(T)
+    return groups
+
+
+##########################
+## FNC: SUBPLOTS LAYOUT ##
+##########################
+def grid_layout(idx_subplots, n_cols, axes_params):
+    n_sp = len(idx_subplots)
+    n_cols = max(min(n_cols, n_sp), 1)
+    n_rows = -(-n_sp // n_cols)
+    h_spacing = 0.2 / n_cols  # Same default spacing as plotly make_subplots with subplot titles
+    v_spacing = 0.5 / n_rows
+    width = (1 - h_spacing * (n_cols - 1)) / n_cols
+    height = (1 - v_spacing * (n_rows - 1)) / n_rows
+
+    x_borders = {kk: axes_params['X'][kk] for kk in ['showline', 'linecolor', 'linewidth', 'mirror']
+                 if kk in axes_params['X']}
+
+    axes_layout, annotations, refs = {}, [], []
+    for sp in range(n_sp):
+        row, col = sp // n_cols, sp % n_cols
+        # Domains from the row/column index, clamped against float round-off as in make_subplots
+        x_left = min(col * (width + h_spacing), 1)
+        x_right = min(x_left + width, 1)
+        y_bottom = max((n_rows - 1 - row) * (height + v_spacing), 0)
+        y_top = min(y_bottom + height, 1)
+        suffix = '' if sp == 0 else str(sp + 1)
+        refs.append(('x' + suffix, 'y' + suffix))
+
+        x_axis = dict(domain=[x_left, x_right], anchor='y' + suffix, **x_borders)
+        if sp > 0:
+            x_axis['matches'] = 'x'  # Shared x-axis
+        if sp + n_cols >= n_sp:  # Bottom subplot of its column
+            x_axis.update(axes_params['X'])
+        else:
+            x_axis['showticklabels'] = False
+        axes_layout['xaxis' + suffix] = x_axis
+
+        y_axis = dict(domain=[y_bottom, y_top], anchor='x' + suffix)
+        y_axis.update(axes_params['Y'][sp])
+        axes_layout['yaxis' + suffix] = y_axis
+
+        annotations.append(dict(text=str(idx_subplots[sp]), x=(x_left + x_right) / 2, y=y_top,
+                                xref='paper', yref='paper', xanchor='center', yanchor='bottom',
+                                showarrow=False, font=dict(size=16)))
+
+    axes_layout['annotations'] = annotations
+    return axes_layout, refs
+
+
 ############################
 ## FNC: "PANDAS" SUBPLOTS ##
 ############################
-def inner_subplot(data, x, main_logo_source, proj_logo_source, traces_params, layout_params, axes_params):
+def inner_subplot(data, x, main_logo_source, proj_logo_source, traces_params, layout_params, axes_params,
+                  n_cols=1):
     idx_subplots, n_sp = calc_subplots(data)
-    fig = make_subplots(rows=n_sp, cols=1, shared_xaxes=True, subplot_titles=[str(T) for T in idx_subplots])
+    axes_layout, refs = grid_layout(idx_subplots, n_cols, axes_params)
 
+    groups = group_columns(data)
+
+    trace_list = []
     for subplot in range(n_sp):
-        for dd in pd.DataFrame(data[idx_subplots[subplot]]).sort_index().columns:
+        for dd in groups[idx_subplots[subplot]]:
 
             if data.columns.nlevels > 1:
-                leg_name = str(idx_subplots[subplot] + (dd,))
+                leg_name = str(dd)
                 leg_showlegend = True
             else:
                 leg_name = dd
                 leg_showlegend = False
             leg_legendgroup = None
 
-            fig.add_trace(go.Scatter(x=x, y=pd.DataFrame(data[idx_subplots[subplot]])[dd],
-                                     name=leg_name,
-                                     showlegend=leg_showlegend,
-                                     legendgroup=leg_legendgroup,
-                                     **traces_params[subplot]
-                                     ), row=subplot + 1, col=1)
-
-        fig.update_yaxes(axes_params['Y'][subplot], row=subplot+1, col=1)
+            trace_list.append(go.Scatter(x=x, y=data[dd],
+                                         name=leg_name,
+                                         showlegend=leg_showlegend,
+                                         legendgroup=leg_legendgroup,
+                                         xaxis=refs[subplot][0], yaxis=refs[subplot][1],
+                                         **traces_params[subplot]
+                                         ))
 
-    fig.update_xaxes(axes_params['X'], row=n_sp, col=1)
-    try:
-        fig.update_xaxes(showline=axes_params['X']['showline'], linecolor=axes_params['X']['linecolor'],
-                         linewidth=axes_params['X']['linewidth'], mirror=axes_params['X']['mirror'])
-    except:
-        pass
+    fig = go.Figure(data=trace_list)  # All traces and axes are set in one pass
+    fig.update_layout(axes_layout)
 
     fig.update_layout(layout_params)
 
@@ -422,6 +486,239 @@ def inner_subplot(data, x, main_logo_source, proj_logo_source, traces_params, la
     return fig
 
 
+###############################
+## FNC: 3D POINTS DECIMATION ##
+###############################
+def voxel_index(points, n_cells):
+    # Flat index of the cell of a regular n_cells^3 grid containing each point
+    p_min = points.min(axis=0)
+    p_span = points.max(axis=0) - p_min
+    p_span[p_span == 0] = 1
+    cells = np.floor((points - p_min) / p_span * n_cells).astype(np.int64)
+    cells = np.clip(cells, 0, n_cells - 1)
+    return (cells[:, 0] * n_cells + cells[:, 1]) * n_cells + cells[:, 2]
+
+
+def decimate_points(data, x, y, z, max_points, method='voxel'):
+    # Row positions of data to keep, None if no decimation is needed
+    if max_points is None:
+        return None
+    if max_points < 1:
+        raise ValueError('max_points must be at least 1')
+    if method not in ['voxel', 'random']:
+        raise ValueError('Decimation method not yet implemented')
+    if len(data) <= max_points:
+        return None
+    if not all(isinstance(cc, str) and cc in data.columns for cc in (x, y, z)):
+        raise TypeError('x, y and z must be column names of data to use max_points')
+
+    points = data[[x, y, z]].to_numpy(dtype=float)
+    valid = np.isfinite(points).all(axis=1)
+    rows = np.flatnonzero(valid)
+    points = points[valid]
+    if len(points) <= max_points:
+        return rows
+
+    if method == 'voxel':
+        # Refine the grid until the occupied cells exceed the budget, keep the finest grid that fits
+        n_cells = max(int(np.floor(max_points ** (1 / 3))), 1)  # n_cells^3 <= max_points always fits
+        keep, n_fit, fine = np.arange(len(points)), n_cells, False
+        while n_cells < 2 ** 19:
+            _, first = np.unique(voxel_index(points, n_cells), return_index=True)
+            if len(first) > max_points:
+                if fine or (n_cells == n_fit + 1):
+                    break
+                n_cells, fine = n_fit + 1, True  # Budget bracketed, refine one cell at a time
+                continue
+            keep, n_fit = first, n_cells
+            if len(first) == len(points):  # No further refinement possible
+                break
+            n_cells = n_cells + 1 if fine else max(int(n_cells * 1.25), n_cells + 1)
+        keep = rows[np.sort(keep)]
+    elif method == 'random':
+        # One point per occupied cell, the rest of the budget split proportionally to the cell counts
+        rng = np.random.default_rng(0)
+        n_cells = max(int(np.ceil((max_points / 10) ** (1 / 3))), 1)
+        cell = voxel_index(points, n_cells)
+        order = rng.permutation(len(points))
+        order = order[np.argsort(cell[order], kind='stable')]  # Grouped by cell, random order inside each cell
+        _, start, counts = np.unique(cell[order], return_index=True, return_counts=True)
+        n_occupied = len(counts)
+        if n_occupied >= max_points:
+            quota = np.zeros(n_occupied, dtype=np.int64)
+            quota[rng.choice(n_occupied, max_points, replace=False)] = 1
+        else:
+            extra = (max_points - n_occupied) * (counts - 1) / (len(points) - n_occupied)
+            quota = 1 + np.floor(extra).astype(np.int64)  # Sums to at most max_points
+        rank = np.arange(len(order)) - np.repeat(start, counts)
+        keep = rows[np.sort(order[rank < np.repeat(quota, counts)])]
+
+    return keep
+
+
+def subset_params(param, keep, n_rows):
+    # Array-like plotly express arguments (color, size, text, ...) follow the rows kept from data
+    param = param.copy()
+    for pp, value in param.items():
+        if isinstance(value, (str, dict)) or np.ndim(value) != 1 or len(value) != n_rows:
+            continue
+        if isinstance(value, list) and all(isinstance(vv, str) for vv in value):  # List of column names
+            continue
+        if isinstance(value, (pd.Series, pd.Index)):
+            param[pp] = value[keep] if isinstance(value, pd.Index) else value.iloc[keep]
+        else:
+            param[pp] = np.asarray(value)[keep]
+    return param
+
+
+##############################
+## FNC: PAYLOAD SIZE BUDGET ##
+##############################
+point_props = ['x', 'y', 'z', 'customdata', 'hovertext', 'text', 'ids',
+               'marker.color', 'marker.size', 'marker.symbol', 'line.color']
+sampled_traces = ['scatter', 'scattergl', 'scatter3d']  # Histogram and box traces are binned from raw samples
+
+
+def figure_size(fig):
+    return len(fig.to_json(validate=False).encode())
+
+
+def drop_hover_data(fig):
+    dropped = False
+    for trace in fig.data:
+        for prop in ['customdata', 'hovertext']:
+            if prop in trace and trace[prop] is not None:
+                trace[prop] = None
+                dropped = True
+        if 'hovertemplate' in trace and trace.hovertemplate is not None and \
+                any(prop in trace.hovertemplate for prop in ['customdata', 'hovertext']):
+            trace.hovertemplate = None  # Template refers to the dropped data
+    return dropped
+
+
+def cast_float32(fig):
+    cast = {}
+    for ii, trace in enumerate(fig.data):
+        for prop in ['x', 'y', 'z']:
+            if prop in trace and trace[prop] is not None:
+                values = np.asarray(trace[prop])
+                if values.dtype == np.float64:
+                    cast[ii, prop] = trace[prop]
+                    trace[prop] = values.astype(np.float32)
+    return cast
+
+
+def downsample_traces(fig, step):
+    for trace in fig.data:
+        if trace.type not in sampled_traces:
+            continue
+        n_points = max(len(trace[pp]) if trace[pp] is not None else 0 for pp in ['x', 'y'])
+        for prop in point_props:
+            if prop in trace and np.ndim(trace[prop]) > 0 and len(trace[prop]) == n_points:
+                trace[prop] = np.asarray(trace[prop])[::step]
+
+
+def fit_to_budget(fig, max_bytes, report=None):
+    report = {} if report is None else report
+    size = initial_size = figure_size(fig)
+    reductions = report['reductions'] = []
+    report['initial_bytes'] = report['final_bytes'] = size
+    if size <= max_bytes:
+        return fig
+
+    if drop_hover_data(fig):
+        size = figure_size(fig)
+        reductions.append('dropped hover data')
+
+    if size > max_bytes:
+        cast = cast_float32(fig)
+        if cast:
+            cast_size = figure_size(fig)
+            if cast_size < size:
+                size = cast_size
+                reductions.append('cast data to float32')
+            else:  # Text serialization of float32 can be longer, restore original data
+                for (ii, prop), values in cast.items():
+                    fig.data[ii][prop] = values
+
+    total_step = 1
+    while size > max_bytes:
+        # Only the sampled traces shrink, template, layout and other traces are a fixed share
+        fixed_size = figure_size(go.Figure(data=[tr for tr in fig.data if tr.type not in sampled_traces],
+                                           layout=fig.layout))
+        if fixed_size >= max_bytes:
+            break
+        step = max(int(np.ceil((size - fixed_size) / (max_bytes - fixed_size))), 2)
+        downsample_traces(fig, step)
+        new_size = figure_size(fig)
+        if new_size >= size:  # Nothing left to downsample
+            break
+        total_step *= step
+        size = new_size
+    if total_step > 1:
+        reductions.append('downsampled traces by {}'.format(total_step))
+
+    logger.warning('Figure reduced from {} to {} bytes to fit max_bytes={}: {}'.format(
+        initial_size, size, max_bytes, ', '.join(reductions) if reductions else 'no reduction applicable'))
+    report['final_bytes'] = size
+    if size > max_bytes:
+        logger.warning('Figure still exceeds max_bytes={} ({} bytes)'.format(max_bytes, size))
+
+    return fig
+
+
+###########################
+## FNC: MEMORY-LEAN DATA ##
+###########################
+def plotted_columns(data, x, y, z):
+    labels = []
+    for cc in (x, y, z):
+        if isinstance(cc, (list, pd.Index)) and (cc is not data.index):
+            labels.extend(cc)
+        elif pd.api.types.is_scalar(cc):
+            labels.append(cc)
+    return [cc for cc in dict.fromkeys(labels) if cc in data.columns]
+
+
+def downcast_columns(data, columns, rtol=1e-5):
+    # float64 -> float32 only if the rounding error is below rtol of the column range
+    data = data.copy(deep=False)
+    for cc in columns:
+        if data[cc].dtype != np.float64:
+            continue
+        values = data[cc].to_numpy()
+        finite = np.isfinite(values)
+        if not finite.any():
+            continue
+        values32 = values.astype(np.float32)
+        error = np.abs(values32[finite] - values[finite]).max()
+        span = values[finite].max() - values[finite].min()
+        if error <= rtol * span:
+            data[cc] = values32
+    return data
+
+
+@contextmanager
+def memory_report(report, enabled):
+    if not enabled:
+        yield
+        return
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        # The caller's tracemalloc peak is reset here, the value before the call is kept in the report
+        report['previous_peak_memory'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.start()
+    try:
+        yield
+    finally:
+        report['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        if not tracing:
+            tracemalloc.stop()
+        logger.info('TC_plot peak memory: {:.1f} MB'.format(report['peak_memory'] / 2 ** 20))
+
+
 #######################
 ## FNC: FUN SELECTOR ##
 #######################
@@ -466,21 +763,45 @@ def TC_plot(data=None, kind='line', x=None, y=None, z=None, show=True, main_logo
 
     plot_fun = fun_selector(kind)  # Select type of plot
 
-    if subplots:
-        _, n_sp = calc_subplots(data)
-        fun_params, traces_params, layout_params, axes_params = process_params_subplot(param, n_sp,
-                                                                                       kind)  # Param preprocess
+    lean_memory = param.pop('lean_memory', False)
+    report = {}  # What was measured or reduced during the call, returned as fig._tc_report
+    with memory_report(report, param.pop('report_memory', False)):
+        max_bytes = param.pop('max_bytes', None)
+        max_points = param.pop('max_points', None)
+        decimation = param.pop('decimation', 'voxel')
+        subplot_cols = param.pop('subplot_cols', 1)
+        if (kind == 'scatter3d') and (data is not None):
+            keep = decimate_points(data, x, y, z, max_points, decimation)  # Point budget for the 3D scene
+            if keep is not None:
+                param = subset_params(param, keep, len(data))
+                data = data.iloc[keep]
+        elif max_points is not None:
+            logger.warning('max_points is only applied for kind=\'scatter3d\', ignored for kind=\'{}\''.format(kind))
+        if lean_memory and (data is not None):
+            columns = data.columns if subplots else plotted_columns(data, x, y, z)
+            data = downcast_columns(data, columns)
+
+        if subplots:
+            _, n_sp = calc_subplots(data)
+            fun_params, traces_params, layout_params, axes_params = process_params_subplot(param, n_sp,
+                                                                                           kind)  # Param preprocess
+
+            fig = inner_subplot(data, x, main_logo_source, proj_logo_source, traces_params, layout_params, axes_params,
+                                n_cols=subplot_cols)
+        else:
+            if data is not None:
+                if isinstance(data.columns, pd.MultiIndex):
+                    raise TypeError('MultiIndex only supported in subplots')
+            # else:
+            fun_params, traces_params, layout_params = process_params(param, kind)  # Param preprocess
 
-        fig = inner_subplot(data, x, main_logo_source, proj_logo_source, traces_params, layout_params, axes_params)
-    else:
-        if data is not None:
-            if isinstance(data.columns, pd.MultiIndex):
-                raise TypeError('MultiIndex only supported in subplots')
-        # else:
-        fun_params, traces_params, layout_params = process_params(param, kind)  # Param preprocess
-
-        fig = inner_plot(plot_fun, data, x, y, z, main_logo_source, proj_logo_source, fun_params, traces_params,
-                             layout_params)  # Plot function
+            fig = inner_plot(plot_fun, data, x, y, z, main_logo_source, proj_logo_source, fun_params, traces_params,
+                                 layout_params)  # Plot function
+
+        if max_bytes is not None:
+            fig = fit_to_budget(fig, max_bytes, report)  # Payload size budget
+
+    fig._tc_report = report
 
     if show:
         fig.show()
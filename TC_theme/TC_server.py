@@ -0,0 +1,365 @@
+#########################
+## IMPORT DEPENDENCIES ##
+#########################
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import stat
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+import pandas as pd
+from .TC_plot import TC_plot
+
+__all__ = ['TC_serve', 'make_server']
+
+logger = logging.getLogger(__name__)
+
+################################
+## LIST OF REQUEST PARAMETERS ##
+################################
+request_params = {'data': 'Data payload in pandas \'split\' orientation (dict with \'data\', \'index\' and \'columns\', optional)',
+                  'data_path': 'Path of a data file relative to the server data root (str, .csv, .parquet or .json in \'split\' orientation, '
+                               '\noptional, used instead of \'data\')',
+                  'kind': 'Type of plot, as in TC_plot (str, default=\'line\')',
+                  'x': 'As in TC_plot (optional)',
+                  'y': 'As in TC_plot (optional)',
+                  'z': 'As in TC_plot (optional)',
+                  'subplots': 'As in TC_plot (bool, default=False)',
+                  'main_logo_source': 'https url, or path relative to the server data root (str, optional)',
+                  'proj_logo_source': 'https url, or path relative to the server data root (str, optional)',
+                  'params': 'Additional TC_plot parameters (dict, optional)',
+                  'format': 'Output format (str, \'html\', \'json\', \'png\', default=\'json\'. \'png\' requires kaleido)',
+                  }
+
+
+############################
+## FNC: REQUEST RENDERING ##
+############################
+def resolve_path(path, data_root):
+    # Requests only reach files below the data root set on the server
+    if data_root is None:
+        raise PermissionError('File access is disabled, no data root set on the server')
+    root = os.path.realpath(data_root)
+    full_path = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, full_path]) != root:
+        raise PermissionError('Path outside the server data root')
+    if not os.path.isfile(full_path):  # Only the requested path is reported, never the server one
+        raise FileNotFoundError('File not found in the server data root: {}'.format(path))
+    return full_path
+
+
+def resolve_logo(source, data_root):
+    if (source is None) or source.startswith('https://'):
+        return source
+    return resolve_path(source, data_root)
+
+
+def load_data(request, data_root):
+    if request.get('data_path') is not None:
+        path = resolve_path(request['data_path'], data_root)
+        if path.endswith('.csv'):
+            return pd.read_csv(path, index_col=0)
+        elif path.endswith('.parquet'):
+            return pd.read_parquet(path)
+        elif path.endswith('.json'):
+            return pd.read_json(path, orient='split')
+        else:
+            raise ValueError('Data file format not yet implemented')
+    elif request.get('data') is not None:
+        return pd.DataFrame(**request['data'])
+    return None
+
+
+def render_plot(request, data_root=None):
+    fig = TC_plot(data=load_data(request, data_root), kind=request.get('kind', 'line'),
+                  x=request.get('x'), y=request.get('y'), z=request.get('z'), show=False,
+                  main_logo_source=resolve_logo(request.get('main_logo_source'), data_root),
+                  proj_logo_source=resolve_logo(request.get('proj_logo_source'), data_root),
+                  subplots=request.get('subplots', False), **request.get('params', {}))
+
+    output_format = request.get('format', 'json')
+    if output_format == 'html':
+        return 'text/html', fig.to_html(include_plotlyjs='cdn').encode()
+    elif output_format == 'json':
+        return 'application/json', fig.to_json().encode()
+    elif output_format == 'png':
+        return 'image/png', fig.to_image(format='png')
+    else:
+        raise ValueError('Output format not yet implemented')
+
+
+def warm_worker():
+    # Load plotly, its validators and the template once per worker process
+    render_plot({'data': {'data': [[0], [1]], 'columns': ['warmup']}})
+
+
+def worker_ready():
+    return True
+
+
+######################
+## CLS: WORKER POOL ##
+######################
+class RenderPool:
+    def __init__(self, workers, max_tasks_per_child=None):
+        self.workers = workers
+        self.max_tasks_per_child = max_tasks_per_child
+        self.lock = threading.Lock()
+        self.executor = self.new_executor()
+        self.restarts = 0
+
+    def new_executor(self):
+        # Spawned workers import TC_theme once and serve every following request warm
+        options = dict(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                       initializer=warm_worker)
+        if (self.max_tasks_per_child is not None) and (sys.version_info >= (3, 11)):
+            options['max_tasks_per_child'] = self.max_tasks_per_child
+        return ProcessPoolExecutor(**options)
+
+    def warm_up(self):
+        for future in [self.executor.submit(worker_ready) for _ in range(self.workers)]:
+            future.result()
+
+    def submit(self, fn, *args):
+        with self.lock:
+            executor = self.executor
+        try:
+            return executor, executor.submit(fn, *args)
+        except RuntimeError:  # Executor broken (BrokenProcessPool) or retired in the meantime, retry once
+            self.recycle(executor)
+            with self.lock:
+                executor = self.executor
+            return executor, executor.submit(fn, *args)
+
+    def recycle(self, executor, grace=0):
+        # Replace a broken or stuck executor, new requests go to fresh workers straight away
+        with self.lock:
+            if self.executor is not executor:  # Already replaced by another request
+                return
+            self.executor = self.new_executor()
+            self.restarts += 1
+        threading.Thread(target=self.retire, args=(executor, grace), daemon=True).start()
+
+    @staticmethod
+    def retire(executor, grace):
+        # Renders still running on the old workers get a grace period, then runaway workers are killed
+        executor.shutdown(wait=False)
+        time.sleep(grace)
+        processes = getattr(executor, '_processes', None) or {}
+        for process in list(processes.values()):
+            if process.is_alive():
+                process.terminate()
+
+    def shutdown(self):
+        with self.lock:
+            self.executor.shutdown()
+
+
+##################
+## CLS: METRICS ##
+##################
+class RenderMetrics:
+    def __init__(self, workers, pool=None, window=1000):
+        self.workers = workers
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.served = 0
+        self.failed = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=window)
+
+    def admit(self, max_pending):
+        with self.lock:
+            if self.pending >= max_pending:
+                self.rejected += 1
+                return False
+            self.pending += 1
+            return True
+
+    def release(self, future=None):
+        with self.lock:
+            self.pending -= 1
+
+    def record(self, start, ok=True):
+        with self.lock:
+            self.latencies.append(time.perf_counter() - start)
+            if ok:
+                self.served += 1
+            else:
+                self.failed += 1
+
+    def snapshot(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = dict(served=self.served, failed=self.failed, rejected=self.rejected,
+                         pending=self.pending, queue_depth=max(self.pending - self.workers, 0),
+                         workers=self.workers, worker_restarts=self.pool.restarts if self.pool else 0)
+        if latencies:
+            stats.update(latency_mean_ms=1000 * sum(latencies) / len(latencies),
+                         latency_p50_ms=1000 * latencies[len(latencies) // 2],
+                         latency_p95_ms=1000 * latencies[min(int(0.95 * len(latencies)), len(latencies) - 1)],
+                         latency_max_ms=1000 * latencies[-1])
+        return stats
+
+
+##################
+## CLS: HANDLER ##
+##################
+class RenderHandler(BaseHTTPRequestHandler):
+    def send_payload(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_message(self, status, message):
+        self.send_payload(status, 'application/json', json.dumps({'error': message}).encode())
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_payload(200, 'application/json', json.dumps(self.server.metrics.snapshot()).encode())
+        elif self.path == '/health':
+            self.send_payload(200, 'application/json', b'{"status": "ok"}')
+        else:
+            self.send_message(404, 'Unknown path')
+
+    def do_POST(self):
+        if self.path != '/plot':
+            self.send_message(404, 'Unknown path')
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError:
+            self.send_message(400, 'Request body is not valid JSON')
+            return
+        if not isinstance(request, dict):
+            self.send_message(400, 'Request body must be a JSON object')
+            return
+
+        metrics = self.server.metrics
+        if not metrics.admit(self.server.max_pending):
+            self.send_message(503, 'Render queue is full')
+            return
+
+        start = time.perf_counter()
+        pool = self.server.pool
+        try:
+            executor, future = pool.submit(render_plot, request, self.server.data_root)
+        except RuntimeError:  # Fresh executor failed as well
+            metrics.release()
+            metrics.record(start, ok=False)
+            self.send_message(503, 'Render workers restarting, retry')
+            return
+        future.add_done_callback(metrics.release)  # The queue slot is freed only when the worker is done
+        try:
+            content_type, body = future.result(timeout=self.server.render_timeout)
+        except FutureTimeoutError:
+            pool.recycle(executor, grace=self.server.render_timeout)  # Do not let runaway renders hold workers
+            metrics.record(start, ok=False)
+            self.send_message(504, 'Render timed out')
+            return
+        except BrokenProcessPool:
+            pool.recycle(executor)  # A worker died (e.g. out of memory), the executor is unusable
+            metrics.record(start, ok=False)
+            self.send_message(503, 'Render worker crashed, retry')
+            return
+        except PermissionError as err:
+            metrics.record(start, ok=False)
+            self.send_message(403, str(err))
+            return
+        except FileNotFoundError as err:
+            metrics.record(start, ok=False)
+            self.send_message(404, str(err))
+            return
+        except (ValueError, TypeError, KeyError) as err:
+            metrics.record(start, ok=False)
+            self.send_message(400, '{}: {}'.format(type(err).__name__, err))
+            return
+        except Exception as err:
+            metrics.record(start, ok=False)
+            self.send_message(500, '{}: {}'.format(type(err).__name__, err))
+            return
+
+        metrics.record(start)
+        self.send_payload(200, content_type, body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # A socket file left by a previous run would make bind fail
+        if os.path.exists(self.server_address) and stat.S_ISSOCK(os.stat(self.server_address).st_mode):
+            os.unlink(self.server_address)
+        super().server_bind()
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+############################
+## FNC: SERVER DEFINITION ##
+############################
+def make_server(host='127.0.0.1', port=8050, socket_path=None, workers=4, max_queue=64, render_timeout=60,
+                data_root=None, max_tasks_per_child=100):
+    if socket_path is not None:
+        server = ThreadingUnixHTTPServer(socket_path, RenderHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RenderHandler)
+
+    server.pool = RenderPool(workers, max_tasks_per_child)
+    server.pool.warm_up()
+
+    server.metrics = RenderMetrics(workers, server.pool)
+    server.data_root = data_root
+    server.max_pending = workers + max_queue
+    server.render_timeout = render_timeout
+    return server
+
+
+#############################
+## MAIN FUNCTION: TC_serve ##
+#############################
+def TC_serve(host='127.0.0.1', port=8050, socket_path=None, workers=4, max_queue=64, render_timeout=60,
+             data_root=None, max_tasks_per_child=100):
+    server = make_server(host, port, socket_path, workers, max_queue, render_timeout, data_root, max_tasks_per_child)
+    logger.info('TC_theme render server listening on {}'.format(socket_path or '{}:{}'.format(host, port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local render server for TC_plot')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--socket-path', default=None, help='Listen on a Unix socket instead of host:port')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--max-queue', type=int, default=64)
+    parser.add_argument('--render-timeout', type=float, default=60)
+    parser.add_argument('--data-root', default=None, help='Directory requests may read data files and logos from')
+    parser.add_argument('--max-tasks-per-child', type=int, default=100)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    TC_serve(args.host, args.port, args.socket_path, args.workers, args.max_queue, args.render_timeout,
+             args.data_root, args.max_tasks_per_child)
@@ -1,3 +1,2 @@
 from .TC_theme import *
 from .TC_plot import *
-
@@ -0,0 +1,136 @@
+from collections import defaultdict
+import logging
+import tracemalloc
+import numpy as np
+import pandas as pd
+import pytest
+from TC_theme import TC_plot
+from TC_theme.TC_plot import decimate_points, fit_to_budget, grid_layout
+
+
+@pytest.mark.parametrize('n_cols', [1, 2, 3, 4])
+def test_grid_layout_domains(n_cols):
+    axes_params = {'X': {}, 'Y': defaultdict(dict)}
+    for n_sp in range(1, 301):
+        axes_layout, refs = grid_layout(list(range(n_sp)), n_cols, axes_params)
+        assert len(refs) == n_sp
+        for name, axis in axes_layout.items():
+            if name != 'annotations':
+                assert 0 <= axis['domain'][0] < axis['domain'][1] <= 1
+
+
+@pytest.mark.parametrize('n_cols', [1, 2, 3, 4])
+def test_subplots_grid(n_cols):
+    for n_sp in range(1, 41):
+        fig = TC_plot(pd.DataFrame(np.zeros((2, n_sp))), subplots=True, subplot_cols=n_cols, show=False)
+        assert len(fig.data) == n_sp
+
+
+def test_subplots_spacing_matches_make_subplots():
+    fig = TC_plot(pd.DataFrame(np.zeros((2, 2))), subplots=True, show=False)
+    assert fig.layout.yaxis.domain == pytest.approx((0.625, 1.0))
+    assert fig.layout.yaxis2.domain == pytest.approx((0.0, 0.375))
+
+
+def test_subplot_cols_ignored_for_wide_frame():
+    data = pd.DataFrame({'a': [0, 1], 'b': [1, 2], 'c': [2, 3]})
+    fig = TC_plot(data, x='a', y=['b', 'c'], subplot_cols=2, show=False)
+    assert len(fig.data) == 2
+
+
+def test_subplot_cols_ignored_for_xy():
+    fig = TC_plot(pd.DataFrame({'a': [0, 1], 'b': [1, 2]}), x='a', y='b', subplot_cols=2, show=False)
+    assert len(fig.data) == 1
+
+
+def test_lean_memory_downcasts_without_tracing():
+    data = pd.DataFrame({'a': np.arange(1000.), 'b': np.linspace(0, 1, 1000)})
+    fig = TC_plot(data, x='a', y='b', lean_memory=True, show=False)
+    assert fig.data[0].y.dtype == np.float32
+    assert 'peak_memory' not in fig._tc_report
+
+
+def test_report_memory():
+    data = pd.DataFrame({'a': np.arange(1000.), 'b': np.linspace(0, 1, 1000)})
+    fig = TC_plot(data, x='a', y='b', report_memory=True, show=False)
+    assert fig._tc_report['peak_memory'] > 0
+    assert 'previous_peak_memory' not in fig._tc_report
+    assert not tracemalloc.is_tracing()
+
+
+def point_cloud(n_points=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    data = pd.DataFrame(rng.normal(size=(n_points, 3)), columns=['a', 'b', 'c'])
+    data['color'] = data['a'] + data['b'] + data['c']
+    return data
+
+
+@pytest.mark.parametrize('method', ['voxel', 'random'])
+@pytest.mark.parametrize('max_points', [1, 100, 1000, 5000])
+def test_decimate_points_budget(method, max_points):
+    keep = decimate_points(point_cloud(), 'a', 'b', 'c', max_points, method)
+    assert 0.7 * max_points <= len(keep) <= max_points
+    assert len(np.unique(keep)) == len(keep)
+
+
+@pytest.mark.parametrize('method', ['voxel', 'random'])
+def test_decimate_points_drops_nan_rows(method):
+    data = point_cloud()
+    data.loc[::10, 'b'] = np.nan
+    keep = decimate_points(data, 'a', 'b', 'c', 1000, method)
+    assert data['b'].iloc[keep].notna().all()
+
+
+def test_decimate_points_invalid_input():
+    with pytest.raises(ValueError):
+        decimate_points(point_cloud(), 'a', 'b', 'c', 0)
+    with pytest.raises(ValueError):
+        decimate_points(point_cloud(), 'a', 'b', 'c', 1000, 'grid')
+
+
+@pytest.mark.parametrize('method', ['voxel', 'random'])
+def test_scatter3d_max_points_keeps_columns_aligned(method):
+    data = point_cloud()
+    fig = TC_plot(data, kind='scatter3d', x='a', y='b', z='c', color=data['color'], text=np.abs(data['a']).round(6).astype(str).to_numpy(),
+                  max_points=1000, decimation=method, show=False)
+    trace = fig.data[0]
+    assert len(trace.x) <= 1000
+    np.testing.assert_allclose(trace.marker.color, trace.x + trace.y + trace.z)
+    np.testing.assert_allclose(np.asarray(trace.text, dtype=float), np.abs(trace.x).round(6))
+
+
+def test_fit_to_budget_scatter():
+    data = point_cloud()
+    fig = TC_plot(data, kind='scatter', x='a', y='b', hover_name='c', show=False)
+    fig.update_traces(marker_color=data['color'].to_numpy(), marker_size=np.arange(len(data)) % 10 + 1)
+    report = {}
+    fig = fit_to_budget(fig, 100000, report)
+    trace = fig.data[0]
+    assert len(fig.to_json()) <= report['final_bytes'] <= 100000
+    assert 'dropped hover data' in report['reductions']
+    assert len(trace.x) == len(trace.y) == len(trace.marker.color) == len(trace.marker.size) < len(data)
+    assert trace.hovertext is None
+    assert (trace.hovertemplate is None) or ('hovertext' not in trace.hovertemplate)
+
+
+@pytest.mark.parametrize('kind', ['hist', 'box'])
+def test_fit_to_budget_keeps_binned_samples(kind, caplog):
+    data = point_cloud()
+    fig = TC_plot(data, kind=kind, x='a', show=False)
+    n_samples = len(fig.data[0].x)
+    fig = fit_to_budget(fig, 100000)
+    assert len(fig.data[0].x) == n_samples
+    assert 'still exceeds' in caplog.text
+
+
+def test_fit_to_budget_fixed_share_over_budget(caplog):
+    fig = TC_plot(point_cloud(), kind='scatter', x='a', y='b', show=False)
+    with caplog.at_level(logging.WARNING):
+        fit_to_budget(fig, 1000)
+    assert 'still exceeds max_bytes=1000' in caplog.text
+
+
+def test_max_bytes_report_on_figure():
+    fig = TC_plot(point_cloud(), kind='scatter', x='a', y='b', max_bytes=100000, show=False)
+    assert fig._tc_report['final_bytes'] <= 100000 < fig._tc_report['initial_bytes']
+    assert fig._tc_report['reductions']
@@ -0,0 +1,113 @@
+import json
+import os
+import socket
+import threading
+import urllib.error
+import urllib.request
+import pandas as pd
+import pytest
+from TC_theme.TC_server import load_data, make_server, resolve_path
+
+
+@pytest.fixture
+def data_root(tmp_path):
+    data = pd.DataFrame({'a': [1.0, 2.0, 3.0]})
+    data.to_csv(tmp_path / 'data.csv')
+    data.to_json(tmp_path / 'data.json', orient='split')
+    return tmp_path
+
+
+def test_resolve_path_rejects_traversal(data_root):
+    assert resolve_path('data.csv', str(data_root)) == str((data_root / 'data.csv').resolve())
+    for path in ['../data.csv', '/etc/hostname', 'sub/../../data.csv']:
+        with pytest.raises(PermissionError):
+            resolve_path(path, str(data_root))
+    with pytest.raises(PermissionError):
+        resolve_path('data.csv', None)
+
+
+def test_resolve_path_missing_file_hides_root(data_root):
+    with pytest.raises(FileNotFoundError) as err:
+        resolve_path('nope.csv', str(data_root))
+    assert str(data_root) not in str(err.value)
+
+
+@pytest.mark.parametrize('file_name', ['data.csv', 'data.json'])
+def test_load_data_formats(data_root, file_name):
+    data = load_data({'data_path': file_name}, str(data_root))
+    assert data['a'].tolist() == [1.0, 2.0, 3.0]
+
+
+def test_load_data_rejects_pickle(data_root):
+    pd.DataFrame({'a': [1]}).to_pickle(data_root / 'data.pkl')
+    with pytest.raises(ValueError):
+        load_data({'data_path': 'data.pkl'}, str(data_root))
+
+
+def test_load_data_inline():
+    data = load_data({'data': {'data': [[1], [2]], 'columns': ['a']}}, None)
+    assert data['a'].tolist() == [1, 2]
+
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+    root = tmp_path_factory.mktemp('root')
+    pd.DataFrame({'a': [1.0, 2.0, 3.0]}).to_csv(root / 'data.csv')
+    server = make_server(port=0, workers=1, render_timeout=30, data_root=str(root))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    server.pool.shutdown()
+
+
+def post(server, body):
+    url = 'http://127.0.0.1:{}/plot'.format(server.server_address[1])
+    request = urllib.request.Request(url, body if isinstance(body, bytes) else json.dumps(body).encode())
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as err:
+        return err.code, err.read()
+
+
+def test_server_round_trip(server):
+    status, body = post(server, {'data': {'data': [[1], [2]], 'columns': ['a']}})
+    assert status == 200
+    assert 'data' in json.loads(body)
+    assert post(server, {'data_path': 'data.csv', 'format': 'html'})[0] == 200
+
+
+def test_server_errors(server):
+    assert post(server, b'not json')[0] == 400
+    assert post(server, [1, 2])[0] == 400
+    assert post(server, {'data_path': 'data.csv', 'format': 'svgz'})[0] == 400
+    assert post(server, {'data_path': '../data.csv'})[0] == 403
+    assert post(server, {'data': {'data': [[1]], 'columns': ['a']}, 'main_logo_source': '/etc/hostname'})[0] == 403
+    status, body = post(server, {'data_path': 'nope.csv'})
+    assert status == 404
+    assert server.data_root not in body.decode()
+
+
+def test_server_queue_full(server):
+    max_pending = server.max_pending
+    server.max_pending = 0
+    try:
+        assert post(server, {'data': {'data': [[1]], 'columns': ['a']}})[0] == 503
+    finally:
+        server.max_pending = max_pending
+    metrics = json.loads(urllib.request.urlopen(
+        'http://127.0.0.1:{}/metrics'.format(server.server_address[1])).read())
+    assert metrics['rejected'] >= 1
+
+
+def test_unix_socket_restart(tmp_path):
+    socket_path = str(tmp_path / 'render.sock')
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(socket_path)  # Socket file left behind by a crashed run
+    stale.close()
+    for _ in range(2):
+        server = make_server(socket_path=socket_path, workers=1)
+        server.server_close()
+        server.pool.shutdown()
+        assert not os.path.exists(socket_path)